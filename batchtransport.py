@@ -0,0 +1,395 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import select
+import socket
+import struct
+import sys
+
+# batched UDP I/O
+# on Linux, recvmmsg(2)/sendmmsg(2) move up to BATCH_SIZE datagrams per syscall
+# through preallocated buffers; elsewhere (no such calls in libc) the same
+# interfaces fall back to one recvfrom/sendto per datagram
+
+BATCH_SIZE = 64 # datagrams per recvmmsg call
+BUFFER_SIZE = 1024 # bytes per datagram slot, NTP datagrams are 48
+SOCKADDR_SIZE = 128 # sizeof(struct sockaddr_storage)
+MSG_DONTWAIT = 0x40
+ADDRESS_CACHE_SIZE = 1024 # parsed peer addresses kept by RecvBatch
+SOCKET_BUFFER_SIZE = 4 << 20 # kernel queue per direction, absorbs client bursts between reads
+# UDP generic segmentation offload (Linux >= 4.18): one sendmsg carries a buffer the kernel
+# splits into equal sized datagrams, receivers see ordinary datagrams
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+GSO_MAX_SEGMENTS = 64 # UDP_MAX_SEGMENTS on older kernels
+
+class _iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", _msghdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+def _load_libc_call(name: str, argtypes: list):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        call = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None # not Linux/glibc
+    call.argtypes = argtypes
+    call.restype = ctypes.c_int
+    return call
+
+_recvmmsg = _load_libc_call("recvmmsg", [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p])
+_sendmmsg = _load_libc_call("sendmmsg", [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int])
+
+def available() -> bool:
+    return _recvmmsg is not None and _sendmmsg is not None
+
+def _raise_errno(call: str):
+    err = ctypes.get_errno()
+    if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        return
+    raise OSError(err, f"{call} failed: {errno.errorcode.get(err, err)}")
+
+# sockaddr fields, family and scope_id in host order, port and flowinfo in network order
+_FAMILY = struct.Struct("=H")
+_PORT = struct.Struct("!H")
+_FLOWINFO = struct.Struct("!I")
+_SCOPE_ID = struct.Struct("=I")
+_SEGMENT_SIZE = struct.Struct("=H") # UDP_SEGMENT cmsg payload
+
+def send_wait(sock: socket.socket, packet, addr: tuple = None) -> None:
+    """send one datagram on a non-blocking socket, waiting for buffer space when it is full"""
+    while True:
+        try:
+            if addr is None:
+                sock.send(packet)
+            else:
+                sock.sendto(packet, addr)
+            return
+        except (BlockingIOError, InterruptedError):
+            select.select([], [sock], [])
+
+def send_once(sock: socket.socket, packet, addr: tuple = None) -> None:
+    """send one datagram, BlockingIOError when the send buffer is full"""
+    if addr is None:
+        sock.send(packet)
+    else:
+        sock.sendto(packet, addr)
+
+def _parse_sockaddr(raw: bytes):
+    """convert struct sockaddr_in/sockaddr_in6 to the address tuple socket.recvfrom would return"""
+    family, = _FAMILY.unpack_from(raw, 0)
+    port, = _PORT.unpack_from(raw, 2)
+    if family == socket.AF_INET:
+        return (socket.inet_ntop(socket.AF_INET, raw[4:8]), port)
+    if family == socket.AF_INET6:
+        flowinfo, = _FLOWINFO.unpack_from(raw, 4)
+        scope_id, = _SCOPE_ID.unpack_from(raw, 24)
+        return (socket.inet_ntop(socket.AF_INET6, raw[8:24]), port, flowinfo, scope_id)
+    return None
+
+def _build_sockaddr(family: int, addr: tuple) -> bytes:
+    """inverse of _parse_sockaddr for a numeric address tuple"""
+    if family == socket.AF_INET:
+        return _FAMILY.pack(family) + _PORT.pack(addr[1]) + socket.inet_pton(family, addr[0]) + bytes(8)
+    flowinfo, scope_id = (addr[2], addr[3]) if len(addr) == 4 else (0, 0)
+    return (_FAMILY.pack(family) + _PORT.pack(addr[1]) + _FLOWINFO.pack(flowinfo)
+            + socket.inet_pton(family, addr[0]) + _SCOPE_ID.pack(scope_id))
+
+class _MessageVector:
+    """preallocated mmsghdr vector, one iovec + sockaddr slot per datagram"""
+    def __init__(self, size: int, bufsize: int):
+        self.size = size
+        self.bufsize = bufsize
+        self.buffers = ctypes.create_string_buffer(size * bufsize)
+        self.names = ctypes.create_string_buffer(size * SOCKADDR_SIZE)
+        self.iovecs = (_iovec * size)()
+        self.headers = (_mmsghdr * size)()
+        self.headers_base = ctypes.addressof(self.headers)
+        self.buffers_base = ctypes.addressof(self.buffers)
+        self.names_base = ctypes.addressof(self.names)
+        for i in range(size):
+            self.iovecs[i].iov_base = self.buffers_base + i * bufsize
+            self.iovecs[i].iov_len = bufsize
+            hdr = self.headers[i].msg_hdr
+            hdr.msg_name = self.names_base + i * SOCKADDR_SIZE
+            hdr.msg_namelen = SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+
+class RecvBatch:
+    """drain pending datagrams from a socket, many per syscall where supported"""
+    def __init__(self, size: int = BATCH_SIZE, bufsize: int = BUFFER_SIZE):
+        self.size = size
+        self.bufsize = bufsize
+        self.vector = _MessageVector(size, bufsize) if _recvmmsg else None
+        self.addresses = {} # raw sockaddr -> address tuple, a client sends many datagrams from one address
+
+    def recv(self, sock: socket.socket) -> list:
+        """read up to `size` datagrams already queued, without blocking, return [(data, addr), ...]"""
+        if self.vector is None:
+            return self._recv_fallback(sock)
+        vector = self.vector
+        count = _recvmmsg(sock.fileno(), vector.headers, self.size, MSG_DONTWAIT, None)
+        if count < 0:
+            _raise_errno("recvmmsg")
+            return []
+        packets = []
+        addresses = self.addresses
+        for i in range(count):
+            header = vector.headers[i]
+            data = ctypes.string_at(vector.buffers_base + i * self.bufsize, header.msg_len)
+            name = ctypes.string_at(vector.names_base + i * SOCKADDR_SIZE, header.msg_hdr.msg_namelen)
+            header.msg_hdr.msg_namelen = SOCKADDR_SIZE # kernel overwrites with actual length
+            addr = addresses.get(name)
+            if addr is None:
+                if len(addresses) >= ADDRESS_CACHE_SIZE:
+                    addresses.clear()
+                addr = addresses[name] = _parse_sockaddr(name)
+            packets.append((data, addr))
+        return packets
+
+    def _recv_fallback(self, sock: socket.socket) -> list:
+        packets = []
+        while len(packets) < self.size and select.select([sock], [], [], 0)[0]:
+            try:
+                packets.append(sock.recvfrom(self.bufsize))
+            except (BlockingIOError, InterruptedError, socket.timeout):
+                break
+        return packets
+
+_UNSET = object() # SendBatch.addr before the sockaddr slots hold any one destination
+
+class SendBatch:
+    """send many datagrams to one address (None on a connected socket), many per syscall where supported
+       equal sized datagrams go out as one GSO buffer, others through sendmmsg
+       send_each() takes a destination per datagram, e.g. server replies
+       wait=False does not wait for buffer space, a full send buffer raises BlockingIOError"""
+    def __init__(self, size: int = BATCH_SIZE, bufsize: int = BUFFER_SIZE, gso: bool = True, wait: bool = True):
+        self.size = size
+        self.bufsize = bufsize
+        self.vector = _MessageVector(size, bufsize) if _sendmmsg else None
+        self.addr = _UNSET # destination currently filled into the sockaddr slots, None: connected
+        self.names = {} # address tuple -> raw sockaddr, for send_each
+        # disabled on the first refusal (old kernel, no checksum offload on the route)
+        self.gso = gso and sys.platform.startswith("linux") and hasattr(socket.socket, "sendmsg")
+        self.wait = wait
+        self.send_one = send_wait if wait else send_once
+
+    def send(self, sock: socket.socket, packets: list, addr: tuple) -> None:
+        if self.gso and len(packets) > 1:
+            segment = len(packets[0])
+            if all(len(packet) == segment for packet in packets):
+                try:
+                    for start in range(0, len(packets), GSO_MAX_SEGMENTS):
+                        while True:
+                            try:
+                                self._send_segmented(sock, packets[start:start + GSO_MAX_SEGMENTS], segment, addr)
+                                break
+                            except (BlockingIOError, InterruptedError):
+                                if not self.wait:
+                                    raise
+                                select.select([], [sock], []) # send buffer full
+                    return
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.EIO, errno.ENOPROTOOPT, errno.EOPNOTSUPP):
+                        raise
+                    self.gso = False # nothing was sent by the failed call, resend below
+                    packets = packets[start:]
+        if self.vector is None:
+            for packet in packets:
+                self.send_one(sock, packet, addr)
+            return
+        for start in range(0, len(packets), self.size):
+            self._send_vector(sock, packets[start:start + self.size], addr)
+
+    def send_each(self, sock: socket.socket, messages: list, error_received=None) -> None:
+        """send [(data, addr), ...], each datagram to its own address
+           with `error_received`, a datagram that cannot be sent is skipped and its OSError
+           passed to error_received(exc), the others still go out"""
+        if self.vector is None:
+            for packet, addr in messages:
+                self._send_one_each(sock, packet, addr, error_received)
+            return
+        for start in range(0, len(messages), self.size):
+            self._send_vector_each(sock, messages[start:start + self.size], error_received)
+
+    def _send_one_each(self, sock: socket.socket, packet, addr: tuple, error_received) -> None:
+        try:
+            self.send_one(sock, packet, addr)
+        except OSError as e:
+            if error_received is None:
+                raise
+            error_received(e)
+
+    def _send_segmented(self, sock: socket.socket, packets: list, segment: int, addr: tuple) -> None:
+        ancillary = [(SOL_UDP, UDP_SEGMENT, _SEGMENT_SIZE.pack(segment))]
+        if addr is None:
+            sock.sendmsg([b"".join(packets)], ancillary)
+        else:
+            sock.sendmsg([b"".join(packets)], ancillary, 0, addr)
+
+    def _send_vector(self, sock: socket.socket, packets: list, addr: tuple) -> None:
+        vector = self.vector
+        if addr != self.addr:
+            name = b"" if addr is None else _build_sockaddr(sock.family, addr) # no msg_name when connected
+            for i in range(self.size):
+                ctypes.memmove(vector.names_base + i * SOCKADDR_SIZE, name, len(name))
+                vector.headers[i].msg_hdr.msg_namelen = len(name)
+            self.addr = addr
+        for i, packet in enumerate(packets):
+            ctypes.memmove(vector.buffers_base + i * self.bufsize, bytes(packet), len(packet))
+            vector.iovecs[i].iov_len = len(packet)
+        sent = _sendmmsg(sock.fileno(), vector.headers, len(packets), 0)
+        if sent < 0:
+            _raise_errno("sendmmsg")
+            sent = 0
+        for packet in packets[sent:]:
+            self.send_one(sock, packet, addr) # send buffer full
+
+    def _send_vector_each(self, sock: socket.socket, messages: list, error_received) -> None:
+        vector = self.vector
+        names = self.names
+        for i, (packet, addr) in enumerate(messages):
+            name = names.get(addr)
+            if name is None:
+                if len(names) >= ADDRESS_CACHE_SIZE:
+                    names.clear()
+                name = names[addr] = _build_sockaddr(sock.family, addr)
+            ctypes.memmove(vector.names_base + i * SOCKADDR_SIZE, name, len(name))
+            vector.headers[i].msg_hdr.msg_namelen = len(name)
+            ctypes.memmove(vector.buffers_base + i * self.bufsize, bytes(packet), len(packet))
+            vector.iovecs[i].iov_len = len(packet)
+        self.addr = _UNSET # slots no longer hold a single destination
+        sent = 0
+        while sent < len(messages):
+            headers = vector.headers
+            if sent:
+                headers = ctypes.cast(vector.headers_base + sent * ctypes.sizeof(_mmsghdr), ctypes.POINTER(_mmsghdr))
+            count = _sendmmsg(sock.fileno(), headers, len(messages) - sent, 0)
+            if count > 0:
+                sent += count
+                continue
+            # sendmmsg stops at the first datagram it cannot send: retry that one alone for its
+            # own error (or to wait for buffer space), then carry on with the rest
+            packet, addr = messages[sent]
+            self._send_one_each(sock, packet, addr, error_received)
+            sent += 1
+
+class BatchDatagramTransport(asyncio.DatagramTransport):
+    """minimal datagram transport reading through RecvBatch
+       datagrams sent while a batch is being delivered go out together through SendBatch"""
+    def __init__(self, loop, sock, protocol):
+        super().__init__()
+        self._loop = loop
+        self._sock = sock
+        self._protocol = protocol
+        self._batch = RecvBatch()
+        # replies go to many clients, GSO needs a single destination; never wait on the event loop
+        self._sender = SendBatch(gso=False, wait=False)
+        self._pending = None # replies collected during _read_ready, None outside it
+        self._closing = False
+        self._loop.add_reader(self._sock.fileno(), self._read_ready)
+        self._loop.call_soon(self._protocol.connection_made, self)
+
+    def _read_ready(self):
+        try:
+            packets = self._batch.recv(self._sock)
+        except OSError as e:
+            self._protocol.error_received(e)
+            return
+        self._pending = []
+        try:
+            for data, addr in packets:
+                self._protocol.datagram_received(data, addr)
+        finally:
+            pending, self._pending = self._pending, None
+            if pending and not self._closing:
+                self._sender.send_each(self._sock, pending, self._send_error)
+
+    def _send_error(self, exc):
+        """one reply of a batch failed, the others are still sent"""
+        if not isinstance(exc, BlockingIOError): # send buffer full: dropped, as in sendto()
+            self._protocol.error_received(exc)
+
+    def sendto(self, data, addr=None):
+        if self._closing:
+            return
+        if self._pending is not None:
+            self._pending.append((bytes(data), addr)) # callers may reuse `data` right away
+            return
+        try:
+            self._sock.sendto(data, addr)
+        except BlockingIOError:
+            pass # send buffer full: drop the datagram as the network would, the client retransmits
+        except OSError as e:
+            self._protocol.error_received(e)
+
+    def get_extra_info(self, name, default=None):
+        if name == "socket":
+            return self._sock
+        if name == "sockname":
+            return self._sock.getsockname()
+        return default
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._loop.call_soon(self._protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+def set_buffer_sizes(sock: socket.socket, size: int = SOCKET_BUFFER_SIZE) -> None:
+    """enlarge SO_RCVBUF/SO_SNDBUF, best effort: the kernel may clamp (Linux: net.core.rmem_max/wmem_max)"""
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+        except OSError:
+            pass
+
+async def create_batch_endpoint(loop, protocol_factory, local_addr, reuse_port=False):
+    """drop-in for loop.create_datagram_endpoint(protocol_factory, local_addr=..., reuse_port=...)"""
+    if _recvmmsg is None:
+        transport, protocol = await loop.create_datagram_endpoint(protocol_factory, local_addr=local_addr, reuse_port=reuse_port or None)
+        set_buffer_sizes(transport.get_extra_info("socket"))
+        return transport, protocol
+    family, type, proto, _, sockaddr = socket.getaddrinfo(*local_addr, type=socket.SOCK_DGRAM)[0]
+    sock = socket.socket(family, type, proto)
+    try:
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        set_buffer_sizes(sock)
+        sock.bind(sockaddr)
+        sock.setblocking(False) # runs on the event loop, a full send buffer must not stall it
+    except OSError:
+        sock.close()
+        raise
+    protocol = protocol_factory()
+    transport = BatchDatagramTransport(loop, sock, protocol)
+    return transport, protocol
@@ -4,6 +4,17 @@ from enum import IntEnum
 
 UNIX_TO_NTP = 2208988800
 
+# precompiled wire format, avoids re-parsing the format string on every datagram
+_NTP_STRUCT = struct.Struct("!B B b b I I I I I I I I I I I")
+
+# byte offsets within a serialized datagram, for patching prebuilt frames
+ROOTDELAY_OFFSET = 4
+ROOTDISPERSION_OFFSET = 8
+REFTIME_FRAC_OFFSET = 20
+ORG_WHOLE_OFFSET = 24
+XMT_WHOLE_OFFSET = 40
+XMT_FRAC_OFFSET = 44
+
 class NTPmode(IntEnum):
     RESERVE = 0
     ACTIVE = 1
@@ -13,9 +24,23 @@ class NTPmode(IntEnum):
     BROADCAST = 5
     CONTROL = 6
 
+# first header byte -> (leap, version, mode), None where the mode bits are not a valid NTPmode
+_MODES = {mode.value: mode for mode in NTPmode}
+_LI_VN_MODE = tuple(
+    ((b >> 6) & 0b11, (b >> 3) & 0b111, _MODES[b & 0b111]) if (b & 0b111) in _MODES else None
+    for b in range(256)
+)
+
 class NTPdatagram:
-    _FORMAT = "!B B b b I I I I I I I I I I I"
-    _SIZE = struct.calcsize(_FORMAT)
+    # one per datagram: no per-instance __dict__
+    __slots__ = (
+        'leap', 'version', 'mode', 'stratum', 'poll', 'precision',
+        'rootdelay', 'rootdispersion', 'refid',
+        'reftime_whole', 'reftime_frac', 'org_whole', 'org_frac',
+        'rec_whole', 'rec_frac', 'xmt_whole', 'xmt_frac',
+    )
+    _FORMAT = _NTP_STRUCT.format
+    _SIZE = _NTP_STRUCT.size
     _RANGES = {
         'leap': (0, 3), # 2 bits
         'version': (0, 7), # 3 bits, always 3
@@ -68,9 +93,15 @@ class NTPdatagram:
             setattr(self, field, value)
 
     def to_bytes(self):
+        return _NTP_STRUCT.pack(*self._fields())
+
+    def pack_into(self, buffer, offset=0):
+        """serialize into a preallocated writable buffer, e.g. a reused bytearray"""
+        _NTP_STRUCT.pack_into(buffer, offset, *self._fields())
+
+    def _fields(self):
         li_vn_mode = (self.leap << 6) | (self.version << 3) | self.mode.value
-        return struct.pack(
-            self._FORMAT,
+        return (
             li_vn_mode,
             self.stratum,
             self.poll,
@@ -92,27 +123,38 @@ class NTPdatagram:
     def from_bytes(cls, data):
         if len(data) != cls._SIZE:
             raise ValueError(f"Invalid datagram size. Expected: {cls._SIZE}, got: {len(data)}")
-        unpacked = struct.unpack(cls._FORMAT, data)
-        li_vn_mode = unpacked[0]
-        return cls(
-            leap=(li_vn_mode >> 6) & 0b11,
-            version=(li_vn_mode >> 3) & 0b111,
-            mode=NTPmode(li_vn_mode & 0b111),
-            stratum=unpacked[1],
-            poll=unpacked[2],
-            precision=unpacked[3],
-            rootdelay=unpacked[4],
-            rootdispersion=unpacked[5],
-            refid=unpacked[6],
-            reftime_whole=unpacked[7],
-            reftime_frac=unpacked[8],
-            org_whole=unpacked[9],
-            org_frac=unpacked[10],
-            rec_whole=unpacked[11],
-            rec_frac=unpacked[12],
-            xmt_whole=unpacked[13],
-            xmt_frac=unpacked[14],
-        )
+        # every unpacked field is in range by construction: skip __init__ validation
+        # and assign straight from the tuple
+        ntp = cls.__new__(cls)
+        (
+            li_vn_mode,
+            ntp.stratum,
+            ntp.poll,
+            ntp.precision,
+            ntp.rootdelay,
+            ntp.rootdispersion,
+            ntp.refid,
+            ntp.reftime_whole,
+            ntp.reftime_frac,
+            ntp.org_whole,
+            ntp.org_frac,
+            ntp.rec_whole,
+            ntp.rec_frac,
+            ntp.xmt_whole,
+            ntp.xmt_frac,
+        ) = _NTP_STRUCT.unpack_from(data)
+        header = _LI_VN_MODE[li_vn_mode]
+        if header is None:
+            raise ValueError(f"{li_vn_mode & 0b111} is not a valid NTPmode")
+        ntp.leap, ntp.version, ntp.mode = header
+        return ntp
+
+    def clone(self):
+        """field-for-field copy, skips the pickle protocol walk of copy.copy"""
+        ntp = self.__class__.__new__(self.__class__)
+        for field in self.__slots__:
+            setattr(ntp, field, getattr(self, field))
+        return ntp
 
     def is_ntpspy(self, magic):
         return self.rootdelay == magic
@@ -120,7 +162,7 @@ class NTPdatagram:
     def __eq__(self, other):
         if not isinstance(other, NTPdatagram):
             return False
-        return vars(self) == vars(other)
+        return self._fields() == other._fields()
     
     def __repr__(self) -> str:
         def ntptime(seconds):
@@ -1,10 +1,14 @@
 from ntpspyserver import NTPspyServer
 from ntpspyclient import NTPspyClient
-from ntpspymessage import NTPspyStatus
+from ntpspymessage import NTPspyStatus, BASE_CHUNK_SIZE, MAX_CHUNK_SIZE
+from storageprovider import DiskStorageProvider
 from pathlib import Path
 import argparse
 import asyncio
 import logging
+import os
+import signal
+import socket
 import sys
 
 DEFAULT_NTP_PORT = 123
@@ -26,15 +30,27 @@ logconsole.setFormatter(formatter)
 logger = logging.getLogger("NTPspy")
 logger.addHandler(logconsole)
 
+def _hex32(value: str) -> int:
+    """argparse type for magic numbers: hex 1-FFFFFFFF"""
+    try:
+        number = int(value, 16)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid hex value: '{value}'")
+    if not 1 <= number <= 0xFFFFFFFF:
+        raise argparse.ArgumentTypeError(f"out of range (1-FFFFFFFF): '{value}'")
+    return number
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="NTPspy - data tunneling over NTP")
     parser.add_argument("-s", "--server", type=str, nargs='?', const=DEFAULT_PATH, help="Server mode [storage path] (default CWD)")
     parser.add_argument("-p", "--port", type=int, default=DEFAULT_NTP_PORT, help="Port number")
-    parser.add_argument("-m", "--magic", type=lambda x: int(x,16), default=DEFAULT_MAGIC_NUMBER, help="Magic number (hex 1-FFFFFFFF)")
+    parser.add_argument("-m", "--magic", type=_hex32, default=DEFAULT_MAGIC_NUMBER, help="Magic number (hex 1-FFFFFFFF)")
     parser.add_argument("-v", "--verbose", action="count", default=0, help="Verbose mode (repeatable)")
     parser.add_argument("-o", "--overwrite", action="store_true", help="Allow overwrite existing files (server only)")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Worker processes sharing the port (server only, Linux)")
     parser.add_argument("-q", "--query", action="store_true", help="Query server version and exit (client only)")
     parser.add_argument("-t", "--time", type=int, default=0, help="Minimum interval (sec) (client only)")
+    parser.add_argument("-c", "--chunk", type=int, default=MAX_CHUNK_SIZE, help=f"Max payload bytes per datagram, {BASE_CHUNK_SIZE}-{MAX_CHUNK_SIZE} (client only)")
     parser.add_argument("remote", type=str, nargs='?', help="Remote host (client only)")
     parser.add_argument("files", type=str, nargs='*', help="Filename to transfer (client only)")
     parser.add_argument("-V", "--version", action="version", version=f"%(prog)s {__version__}", help="Show version and exit")
@@ -69,14 +85,45 @@ if __name__ == "__main__":
         logger.info(f"NTPspy {__version__} starting in server mode.")
         if args.server == DEFAULT_PATH:
             logger.warning(f"Storing files in default path: '{DEFAULT_PATH}'")
+        worker = 0 # 0 is the parent process
+        children = [] # worker pids, parent only
+        if args.workers > 1:
+            if not (hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")):
+                logger.error("Multiple workers require fork() and SO_REUSEPORT")
+                exit(1)
+            # sweep leftover buffer files once, before any worker can allocate a session
+            if os.path.isdir(args.server):
+                DiskStorageProvider.remove_orphaned_files(args.server, logger)
+            # each worker binds its own socket to the port, the kernel hashes each
+            # client to one of them so sessions never span processes
+            for index in range(1, args.workers):
+                pid = os.fork()
+                if pid == 0:
+                    worker = index
+                    children = []
+                    break
+                children.append(pid)
+            if hasattr(os, "sched_setaffinity"):
+                cpus = sorted(os.sched_getaffinity(0))
+                os.sched_setaffinity(0, {cpus[worker % len(cpus)]})
+            logger.info(f"Worker {worker} started, pid {os.getpid()}")
         server = NTPspyServer(
             path = args.server, 
             port = port, 
             verbose = args.verbose, 
             magic_number = args.magic, 
             allow_overwrite = args.overwrite,
+            reuse_port = args.workers > 1,
+            storage_provider = DiskStorageProvider(args.server, remove_orphans = args.workers == 1),
         )
         asyncio.run(server.start())
+        # whatever stopped the parent's own server stops the workers too
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass # already gone
+            os.waitpid(pid, 0)
 
     # client mode
     elif hostname:
@@ -85,49 +132,53 @@ if __name__ == "__main__":
             port = port, 
             verbose = args.verbose, 
             magic_number = args.magic, 
-            interval = args.time
+            interval = args.time,
+            max_chunk_size = args.chunk,
         )
 
-        ## probe only
-        if args.query:
-            probe = client.probe()
-            if not probe:
-                logger.error("Probe failed. Server unreachable, not NTPspy, or wrong magic number.")
-                exit(1)
-            else:
-                logger.debug(f"{probe}")
-                logger.info(f"Server version: {probe.version}, Status: {NTPspyStatus(probe.status).name}")
+        try:
+            ## probe only
+            if args.query:
+                probe = client.probe()
+                if not probe:
+                    logger.error("Probe failed. Server unreachable, not NTPspy, or wrong magic number.")
+                    exit(1)
+                else:
+                    logger.debug(f"{probe}")
+                    logger.info(f"Server version: {probe.version}, Status: {NTPspyStatus(probe.status).name}")
+                    exit(0)
                 exit(0)
-            exit(0)
 
-        ## process files
-        if args.files:
-            for filename in args.files:
-                if filename != "-":
-                    client.transfer_file(filename)
-                else:
-                    print("Reading input from terminal, send EOF (Ctrl+d or Ctrl+z on Win) to finish.")
-                    data = sys.stdin.buffer.read()
-                    if not data:
-                        logger.warning("No data to send. Skipping.")
-                        continue
-                    logger.debug(f"Read {len(data)} bytes of unnamed data")
-                    client.transfer_session(data, None)
+            ## process files
+            if args.files:
+                for filename in args.files:
+                    if filename != "-":
+                        client.transfer_file(filename)
+                    else:
+                        print("Reading input from terminal, send EOF (Ctrl+d or Ctrl+z on Win) to finish.")
+                        data = sys.stdin.buffer.read()
+                        if not data:
+                            logger.warning("No data to send. Skipping.")
+                            continue
+                        logger.debug(f"Read {len(data)} bytes of unnamed data")
+                        client.transfer_session(data, None)
         
-        ## read piped input
-        elif not sys.stdin.isatty():
-            data = sys.stdin.buffer.read()
-            if not data:
-                logger.error("Empty pipe")
-                exit(1)
-            logger.debug(f"Read {len(data)} bytes of unnamed data")
-            client.transfer_session(data, None)
+            ## read piped input
+            elif not sys.stdin.isatty():
+                data = sys.stdin.buffer.read()
+                if not data:
+                    logger.error("Empty pipe")
+                    exit(1)
+                logger.debug(f"Read {len(data)} bytes of unnamed data")
+                client.transfer_session(data, None)
 
-        ## no filenames or pipe input
-        else:
-            logger.error("No filenames or piped data detected.")
-            parser.print_help()
-            exit(1)
+            ## no filenames or pipe input
+            else:
+                logger.error("No filenames or piped data detected.")
+                parser.print_help()
+                exit(1)
+        finally:
+            client.close()
 
     # no remote and not -s
     else:
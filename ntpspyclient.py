@@ -1,10 +1,16 @@
 import socket
 import logging
+import mmap
+import os
+import select
+import struct
 import time
 import zlib
-from ntpdatagram import NTPdatagram
-from ntpspymessage import NTPspyFunction, NTPspyMessage, NTPspyStatus
+from concurrent.futures import ThreadPoolExecutor
+from ntpdatagram import NTPdatagram, ROOTDELAY_OFFSET, XMT_WHOLE_OFFSET
+from ntpspymessage import NTPspyFunction, NTPspyMessage, NTPspyStatus, LENGTH_OFFSET, SEQUENCE_OFFSET, PAYLOAD_OFFSET, EXTENSION_OFFSET, BASE_CHUNK_SIZE, MAX_CHUNK_SIZE
 from timestampgen import UNIX_TO_NTP
+from batchtransport import RecvBatch, SendBatch, SOCKET_BUFFER_SIZE, send_wait, set_buffer_sizes
 
 formatter = logging.Formatter(
     fmt='%(asctime)s - %(levelname)s - %(name)s.%(funcName)s - %(message)s',
@@ -14,8 +20,11 @@ logconsole = logging.StreamHandler()
 logconsole.setLevel(logging.DEBUG)
 logconsole.setFormatter(formatter)
 
+_U32 = struct.Struct("!I")
+_NS_PER_SECOND = 1_000_000_000 # whole seconds straight from time_ns(), no float round trip
+
 class NTPspyClient:
-    def __init__(self, remote="localhost", port=1234, magic_number=0xDEADBEEF, timeout=5, verbose=False, version=3, session_id=None, interval=0):
+    def __init__(self, remote="localhost", port=1234, magic_number=0xDEADBEEF, timeout=5, verbose=False, version=3, session_id=None, interval=0, window=64, max_chunk_size=MAX_CHUNK_SIZE, socket_buffer_size=SOCKET_BUFFER_SIZE):
         self.verbose = verbose
         self.server_addr = (remote, port)
         self.timeout = timeout
@@ -25,30 +34,77 @@ class NTPspyClient:
         self.max_retry = 5
         self.progress_interval = 10 # seconds, between progress messages
         self.interval = interval # delay between transmissions (seconds)
+        self.window = window # max unacknowledged chunks in flight when interval is 0
+        self.max_chunk_size = min(max(max_chunk_size, BASE_CHUNK_SIZE), MAX_CHUNK_SIZE) # bytes per datagram to request
+        self.server_chunk_size = BASE_CHUNK_SIZE # advertised in the probe reply
+        self.chunk_size = BASE_CHUNK_SIZE # agreed for the current session
+        self.crc_executor = ThreadPoolExecutor(max_workers=1) # data CRC runs while chunks are sent
 
         self.logger = logging.getLogger(type(self).__name__)
         self.logger.addHandler(logconsole)
         self.set_loglevel(logging.DEBUG if verbose else logging.INFO)
 
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.settimeout(self.timeout)
+        # every wait is an explicit select() with its own deadline, a socket timeout
+        # would only add a hidden poll() before each send and recv
+        self.sock.setblocking(False)
+        # room for a full window of requests and replies, the distro default is tuned for TCP-sized traffic
+        if socket_buffer_size:
+            set_buffer_sizes(self.sock, socket_buffer_size)
+        self.rx_buffer = bytearray(1024) # reused by every _exchange, replies are parsed before the next recv
+        self.rx_view = memoryview(self.rx_buffer)
+        # resolve once, sendto() with a hostname would look it up again for every datagram
+        self.server_sockaddr = socket.getaddrinfo(remote, port, family=self.sock.family, type=socket.SOCK_DGRAM)[0][4]
+        # connected: the kernel skips the route lookup per send and drops datagrams from other peers
+        self.sock.connect(self.server_sockaddr)
         self.logger.info(f"Client socket initialized for {self.server_addr}")
 
-    def send_ntp(self, ntp_msg: NTPdatagram) -> NTPdatagram:
-        try:
-            ntp_msg.xmt_whole = int(time.time()) + UNIX_TO_NTP
-            self.sock.sendto(ntp_msg.to_bytes(), self.server_addr)
+    def send_ntp(self, ntp_msg: NTPdatagram, function: NTPspyFunction = None, sequence: int = 0) -> NTPdatagram:
+        ntp_msg.xmt_whole = time.time_ns() // _NS_PER_SECOND + UNIX_TO_NTP
+        return self._exchange(ntp_msg.to_bytes(), function, sequence)
+
+    def send_frame(self, frame: bytearray, function: NTPspyFunction = None, sequence: int = 0) -> NTPdatagram:
+        """send prebuilt datagram (see NTPspyMessage.to_frame), stamping transmit time in place"""
+        _U32.pack_into(frame, XMT_WHOLE_OFFSET, time.time_ns() // _NS_PER_SECOND + UNIX_TO_NTP)
+        return self._exchange(frame, function, sequence)
 
-            data, addr = self.sock.recvfrom(1024)
-            response = NTPdatagram.from_bytes(data)
-            return response
+    def _exchange(self, packet, function: NTPspyFunction = None, sequence: int = 0) -> NTPdatagram:
+        """send datagram and wait for its reply
+           with `function` set, NTPspy replies to other requests (e.g. late acknowledgements
+           of retransmitted chunks) are skipped rather than taken as the answer"""
+        try:
+            send_wait(self.sock, packet)
+            deadline = time.monotonic() + self.timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([self.sock], [], [], remaining)[0]:
+                    raise socket.timeout
+                try:
+                    nbytes = self.sock.recv_into(self.rx_buffer)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                try:
+                    response = NTPdatagram.from_bytes(self.rx_view[:nbytes])
+                except ValueError:
+                    continue
+                if function is None or not response.is_ntpspy(self.magic_number):
+                    return response
+                if response.poll == function and response.reftime_frac == sequence:
+                    return response
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug(f"Skipped stale reply, function: {response.poll}, seq: {response.reftime_frac}")
         except socket.timeout:
             self.logger.error("Timeout waiting for response.")
             return None
+        except ConnectionError:
+            # ICMP port unreachable, reported on connected sockets
+            self.logger.error("Server refused connection.")
+            return None
 
     def send_ntpspy(self, spy_msg: NTPspyMessage):
-        ntp_msg = spy_msg.to_ntp()
-        reply = self.send_ntp(ntp_msg)
+        return self._ntpspy_reply(self.send_ntp(spy_msg.to_ntp(), spy_msg.function, spy_msg.sequence_number))
+
+    def _ntpspy_reply(self, reply: NTPdatagram):
         if not reply:
             self.logger.error("No response from server.")
             return None
@@ -59,6 +115,7 @@ class NTPspyClient:
             return None
 
     def close(self):
+        self.crc_executor.shutdown()
         self.sock.close()
         self.logger.info("Client socket closed.")
 
@@ -67,11 +124,15 @@ class NTPspyClient:
         self.logger.info(f"Reading transfer source: {filepath}")
         try:
             with open(filepath, 'rb') as f:
-                data = f.read()
+                try:
+                    # pages are read in as chunks are sent and CRC'd, not copied up front
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, OSError):
+                    data = f.read() # empty file, pipe or device
         except Exception as e:
             self.logger.error(e)
             return False
-        filename = filepath.split('/')[-1]
+        filename = os.path.basename(filepath)
         try:
             self.transfer_session(data, filename)
         except KeyboardInterrupt:
@@ -80,6 +141,9 @@ class NTPspyClient:
                 self.logger.info(f"Sending abort message for session: {self.session_id}")
                 self.abort(self.session_id)
             return False
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
         return True
     
     def transfer_session(self, data: bytes, filename: str = None):
@@ -112,15 +176,19 @@ class NTPspyClient:
                 self.logger.error("Filename verification failed. Aborting transfer.")
                 return False
             self.logger.info("Filename verification passed.")            
-        # 4) transfer data in chunks
+        # 4) transfer data in chunks, CRC computed alongside (zlib.crc32 releases the GIL)
         length = len(data)
         self.logger.info(f"Session: {self.session_id} - Transferring {length} bytes with name: '{filename}'")
-        if not self.transfer_data(self.session_id, data, NTPspyFunction.XFER_DATA):
+        data_crc = self.crc_executor.submit(zlib.crc32, data)
+        try:
+            transferred = self.transfer_data(self.session_id, data, NTPspyFunction.XFER_DATA)
+        finally:
+            data_crc = data_crc.result() # never leave the CRC reading `data` past this call
+        if not transferred:
             self.logger.error("Data transfer failed. Aborting transfer.")
             self.abort(self.session_id)
             return False
         # 5) verify data integrity
-        data_crc = zlib.crc32(data)
         if not self.verify(self.session_id, NTPspyFunction.CHECK_DATA, data_crc):
             self.logger.error("Data verification failed. Aborting transfer.")
             self.abort(self.session_id)
@@ -140,25 +208,123 @@ class NTPspyClient:
 
     def transfer_data(self, session_id: int, data: bytes, type: NTPspyFunction) -> bool:
         """transfer block of data (or text) in chunks"""
-        chunk_size = 4  # bytes
+        if self.interval == 0 and self.window > 1:
+            return self.transfer_window(session_id, data, type)
+        chunk_size = self.chunk_size
         chunk_count = len(data) // chunk_size
-        current_time = last_progress = time.time()
-        for sequence, offset in enumerate(range(0, len(data), chunk_size)):
-            chunk = data[offset:offset + chunk_size]
-            if not self.transfer_chunk(session_id, type, sequence, chunk, len(chunk), chunk_count):
-                self.logger.error(f"Session {session_id} Failed to {type.name} chunk {sequence}. Aborting transfer.")
-                self.abort(session_id)
-                return False
-            if self.interval > 0:
-                time.sleep(self.interval)
-            current_time = time.time()
-            if current_time - last_progress >= self.progress_interval:
-                progress = (sequence + 1) / chunk_count * 100
-                self.logger.info(f"Session: {self.session_id} - Progress: {progress:.2f}% ({sequence + 1}/{chunk_count})")
-                last_progress = current_time
+        current_time = last_progress = time.monotonic()
+        frame = self._chunk_frame(session_id, type)
+        # zero-copy chunk slices, released even if the transfer raises: an exported
+        # mmap (see transfer_file) cannot be closed while a view is alive
+        with memoryview(data) as view:
+            for sequence, offset in enumerate(range(0, len(data), chunk_size)):
+                with view[offset:offset + chunk_size] as chunk:
+                    sent = self.transfer_chunk(session_id, type, sequence, chunk, len(chunk), chunk_count, frame)
+                if not sent:
+                    self.logger.error(f"Session {session_id} Failed to {type.name} chunk {sequence}. Aborting transfer.")
+                    self.abort(session_id)
+                    return False
+                if self.interval > 0:
+                    time.sleep(self.interval)
+                current_time = time.monotonic()
+                if current_time - last_progress >= self.progress_interval:
+                    progress = (sequence + 1) / chunk_count * 100
+                    self.logger.info(f"Session: {self.session_id} - Progress: {progress:.2f}% ({sequence + 1}/{chunk_count})")
+                    last_progress = current_time
         self.logger.info(f"Session: {session_id} - {type.name} transfer completed")
         return True
 
+    def transfer_window(self, session_id: int, data: bytes, type: NTPspyFunction) -> bool:
+        """pipelined transfer: keep up to `window` chunks unacknowledged, retransmit on timeout
+           replies echo the sequence number, so chunks may be acknowledged in any order"""
+        chunk_size = self.chunk_size
+        chunk_count = -(-len(data) // chunk_size)
+        frame = self._chunk_frame(session_id, type)
+        sender = SendBatch()
+        receiver = RecvBatch()
+        inflight = {} # sequence -> [packet, last sent, attempts]
+        next_sequence = 0
+        last_progress = time.monotonic()
+        with memoryview(data) as view: # released even if the transfer raises, see transfer_data
+            while next_sequence < chunk_count or inflight:
+                # fill window
+                # timers run on one monotonic read per pass, the wall clock is read only for new chunks
+                batch = []
+                now = time.monotonic()
+                if now - last_progress >= self.progress_interval:
+                    acked = next_sequence - len(inflight)
+                    self.logger.info(f"Session: {session_id} - Progress: {acked / chunk_count * 100:.2f}% ({acked}/{chunk_count})")
+                    last_progress = now
+                if len(inflight) < self.window and next_sequence < chunk_count:
+                    xmt_whole = time.time_ns() // _NS_PER_SECOND + UNIX_TO_NTP
+                while len(inflight) < self.window and next_sequence < chunk_count:
+                    offset = next_sequence * chunk_size
+                    with view[offset:offset + chunk_size] as chunk:
+                        packet = self._chunk_packet(frame, next_sequence, chunk, xmt_whole)
+                    inflight[next_sequence] = [packet, now, 1]
+                    batch.append(packet)
+                    next_sequence += 1
+                # retransmit expired
+                for sequence, entry in inflight.items():
+                    if now - entry[1] < self.timeout:
+                        continue
+                    if entry[2] >= self.max_retry:
+                        self.logger.error(f"Session {session_id} Failed to {type.name} chunk {sequence}. Aborting transfer.")
+                        self.abort(session_id)
+                        return False
+                    self.logger.warning(f"No response from server for chunk {sequence}. Retrying...")
+                    entry[1] = now
+                    entry[2] += 1
+                    batch.append(entry[0])
+                if batch:
+                    try:
+                        sender.send(self.sock, batch, None) # connected, BSD sendto() with an address fails with EISCONN
+                    except ConnectionError:
+                        pass # pending ICMP error reported on send, unsent chunks time out and are resent
+                # collect acknowledgements
+                oldest = min(entry[1] for entry in inflight.values())
+                wait = max(0, oldest + self.timeout - now)
+                if not select.select([self.sock], [], [], wait)[0]:
+                    continue
+                try:
+                    replies = receiver.recv(self.sock)
+                except ConnectionError:
+                    continue # ICMP error from an earlier send, let retransmission handle it
+                for datagram, addr in replies:
+                    # check the magic on the raw bytes, plain NTP replies are never decoded
+                    if len(datagram) != NTPdatagram._SIZE or _U32.unpack_from(datagram, ROOTDELAY_OFFSET)[0] != self.magic_number:
+                        continue
+                    try:
+                        reply = NTPspyMessage.from_ntp(NTPdatagram.from_bytes(datagram))
+                    except ValueError:
+                        continue
+                    if reply.session_id != session_id or reply.function != type:
+                        continue # stale reply from an earlier exchange
+                    if reply.status == NTPspyStatus.FATAL_ERROR:
+                        self.logger.error(f"Server returned fatal error for chunk {reply.sequence_number}. Aborting transfer.")
+                        self.abort(session_id)
+                        return False
+                    inflight.pop(reply.sequence_number, None)
+        self.logger.info(f"Session: {session_id} - {type.name} transfer completed")
+        return True
+
+    def _chunk_packet(self, frame: bytearray, sequence: int, data, xmt_whole: int) -> bytes:
+        """patch chunk into session template and return a snapshot of the datagram"""
+        self._patch_chunk(frame, sequence, data)
+        _U32.pack_into(frame, XMT_WHOLE_OFFSET, xmt_whole)
+        return bytes(frame)
+
+    def _patch_chunk(self, frame: bytearray, sequence: int, data) -> None:
+        # only sequence, length and chunk data differ between chunks of a session
+        _U32.pack_into(frame, SEQUENCE_OFFSET, sequence)
+        _U32.pack_into(frame, LENGTH_OFFSET, len(data))
+        chunk_size = self.chunk_size
+        if len(data) < chunk_size:
+            data = bytes(data).ljust(chunk_size, b'\x00') # zero pad final chunk only
+        frame[PAYLOAD_OFFSET:PAYLOAD_OFFSET + 4] = data[:4]
+        if chunk_size > 4:
+            frame[EXTENSION_OFFSET:EXTENSION_OFFSET + chunk_size - 4] = data[4:]
+
     def probe(self):
         """query server for NTPspy presence and version"""
         self.logger.info(f"Sending probe message to the server. Magic: 0x{self.magic_number:X}, Version: {self.version}")
@@ -184,41 +350,53 @@ class NTPspyClient:
             self.logger.error(f"Version mismatch. Client: {local_version}, Server: {remote_version}")
             return False
         self.logger.debug(f"Version check passed. Client: {local_version}, Server: {remote_version}")
+        # servers predating wide chunks echo the probe's zero payload
+        self.server_chunk_size = probe.payload if BASE_CHUNK_SIZE <= probe.payload <= MAX_CHUNK_SIZE else BASE_CHUNK_SIZE
         return True
 
     def get_session_id(self, storage_required: int) -> int:
+        """request new session ID, agreeing on the chunk size for the session"""
+        requested = min(self.max_chunk_size, self.server_chunk_size)
         session_request = NTPspyMessage(
             function=NTPspyFunction.NEW_SESSION,
             magic=self.magic_number,
             session_id=0,
             payload=storage_required,
+            length=requested if requested > BASE_CHUNK_SIZE else 0,
         )
         for attempt in range(self.max_retry):
             self.logger.info(f"Requesting new session ID. Attempt {attempt + 1}/{self.max_retry}")
             response = self.send_ntpspy(session_request)
             if response and response.status != NTPspyStatus.FATAL_ERROR:
                 new_session = response.session_id
-                self.logger.info(f"Received session ID: {new_session:x}")
+                granted = response.length
+                self.chunk_size = granted if BASE_CHUNK_SIZE <= granted <= requested else BASE_CHUNK_SIZE
+                self.logger.info(f"Received session ID: {new_session:x}, chunk size: {self.chunk_size}")
                 return new_session
             self.logger.warning("Failed to obtain session ID. Retrying...")
         self.logger.error("Exceeded maximum retries. Server denied session request.")
         return None
 
 
-    def transfer_chunk(self, session_id: int, type: NTPspyFunction, sequence: int, data: bytes, length: int, chunkcount: int):
-        """upload single chunk, data or text, to server"""
-        msg = NTPspyMessage(
+    def _chunk_frame(self, session_id: int, type: NTPspyFunction) -> bytearray:
+        """datagram template shared by all chunks of a session, see transfer_chunk"""
+        return NTPspyMessage(
             status = type,
             function = type,
             magic = self.magic_number,
             session_id = session_id,
-            sequence_number = sequence,
-            payload = data[:length],
-            length = len(data)
-        )
+        ).to_frame()
+
+    def transfer_chunk(self, session_id: int, type: NTPspyFunction, sequence: int, data: bytes, length: int, chunkcount: int, frame: bytearray = None):
+        """upload single chunk, data or text, to server"""
+        if frame is None:
+            frame = self._chunk_frame(session_id, type)
+        self._patch_chunk(frame, sequence, data[:length])
+        debug = self.logger.isEnabledFor(logging.DEBUG) # skip formatting per chunk unless it is shown
         for attempt in range(self.max_retry):
-            self.logger.debug(f"Session: {session_id} Chunk: {sequence}/{chunkcount} Attempt: {attempt + 1}/{self.max_retry} Data: {data}")
-            response = self.send_ntpspy(msg)
+            if debug:
+                self.logger.debug(f"Session: {session_id} Chunk: {sequence}/{chunkcount} Attempt: {attempt + 1}/{self.max_retry} Data: {bytes(data)}")
+            response = self._ntpspy_reply(self.send_frame(frame, type, sequence))
             if not response:
                 self.logger.warning(f"No response from server for chunk {sequence}. Retrying...")
                 continue  # Retry on no response
@@ -235,7 +413,7 @@ class NTPspyClient:
             function=type,
             magic=self.magic_number,
             session_id=session_id,
-            payload=expected_crc.to_bytes(4, 'big')
+            payload=expected_crc
         )
         for attempt in range(self.max_retry):
             self.logger.info(f"Session: {session_id} - {type.name} - Attempt CRC check: {expected_crc:08x}")
@@ -310,14 +488,13 @@ class NTPspyClient:
             handler.setLevel(level)
 
 def _readable_size(size: int) -> str:
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if size < 1024:
-            fmt_size = f"{size}" if isinstance(size, int) else f"{size:.2f}"
-            fmt_size = int(float(fmt_size)) if fmt_size.endswith('.00') else fmt_size
-            return f"{fmt_size} {unit}"
-        size /= 1024
-    fmt_size = size if isinstance(size, int) else f"{size:.2f}"
-    return f"{fmt_size} GB"
+    if size < 1024:
+        return f"{size} B"
+    exponent = min(3, (size.bit_length() - 1) // 10) # KB, MB or GB
+    value = f"{size / (1 << (10 * exponent)):.2f}"
+    if value.endswith(".00"):
+        value = value[:-3]
+    return f"{value} {('B', 'KB', 'MB', 'GB')[exponent]}"
 
 if __name__ == "__main__":
     client = NTPspyClient()
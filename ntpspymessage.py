@@ -1,5 +1,6 @@
+import struct
 from enum import IntEnum
-from ntpdatagram import NTPdatagram
+from ntpdatagram import NTPdatagram, ROOTDISPERSION_OFFSET, REFTIME_FRAC_OFFSET, ORG_WHOLE_OFFSET, XMT_FRAC_OFFSET
 
 class NTPspyFunction(IntEnum):
     PROBE = 0
@@ -19,7 +20,27 @@ class NTPspyStatus(IntEnum):
 
 # NTPspy messages are encapsulated within standard NTP datagrams
 
+# wire offsets of the fields that change from chunk to chunk within a session
+LENGTH_OFFSET = ROOTDISPERSION_OFFSET
+SEQUENCE_OFFSET = REFTIME_FRAC_OFFSET
+PAYLOAD_OFFSET = XMT_FRAC_OFFSET
+
+# chunk data: the first 4 bytes travel in the payload field, up to 16 more in the
+# request's originate and receive timestamps (contiguous from EXTENSION_OFFSET),
+# which the server overwrites in its reply anyway
+# the chunk size of a session is agreed in NEW_SESSION, see NTPspyServer.session_init
+EXTENSION_OFFSET = ORG_WHOLE_OFFSET
+BASE_CHUNK_SIZE = 4
+MAX_CHUNK_SIZE = 20
+
+_U32 = struct.Struct("!I")
+# value -> member, a dict lookup is much cheaper than calling the IntEnum per message
+_FUNCTIONS = {member.value: member for member in NTPspyFunction}
+_STATUSES = {member.value: member for member in NTPspyStatus}
+
 class NTPspyMessage:
+    __slots__ = ('status', 'function', 'version', 'magic', 'session_id', 'sequence_number', 'payload', 'length', 'extension')
+
     def __init__(self,
                  status=NTPspyStatus.NORMAL,
                  function=NTPspyFunction.PROBE,
@@ -28,7 +49,8 @@ class NTPspyMessage:
                  session_id=0,
                  sequence_number=0,
                  payload=0,
-                 length=0
+                 length=0,
+                 extension=(0, 0, 0, 0)
                  ):
         self.status = status # ntp.leap : NTPspyStatus
         self.function = function # ntp.poll : NTPspyFunction
@@ -44,20 +66,27 @@ class NTPspyMessage:
         self.payload = payload # ntp.xmt_frac
             # message payload, 32 bit, zero padded, valid range 0-0xFFFFFFFF
         self.length = length # ntp.rootdispersion
-            # length of ntpspy.payload in bytes, valid range 0-4
+            # length of chunk data in bytes, valid range 0-MAX_CHUNK_SIZE
+        self.extension = extension # ntp.org_whole, org_frac, rec_whole, rec_frac
+            # chunk data beyond the first 4 bytes, read from requests only, never written by to_ntp
 
     @classmethod
     def from_ntp(cls, ntp: NTPdatagram):
-        return cls(
-            status=NTPspyStatus(ntp.leap),
-            function=NTPspyFunction(ntp.poll),
-            version=ntp.precision,
-            magic=ntp.rootdelay,
-            session_id=ntp.refid,
-            sequence_number=ntp.reftime_frac,
-            payload=ntp.xmt_frac,
-            length=ntp.rootdispersion
-        )
+        # plain field renames, assigned directly rather than through __init__ keywords
+        msg = cls.__new__(cls)
+        msg.status = _STATUSES[ntp.leap] # 2 bits, every value is a status
+        try:
+            msg.function = _FUNCTIONS[ntp.poll]
+        except KeyError:
+            raise ValueError(f"{ntp.poll} is not a valid NTPspyFunction") from None
+        msg.version = ntp.precision
+        msg.magic = ntp.rootdelay
+        msg.session_id = ntp.refid
+        msg.sequence_number = ntp.reftime_frac
+        msg.payload = ntp.xmt_frac
+        msg.length = ntp.rootdispersion
+        msg.extension = (ntp.org_whole, ntp.org_frac, ntp.rec_whole, ntp.rec_frac)
+        return msg
     
     def to_ntp(self, ntp: NTPdatagram=None) -> NTPdatagram:
         if ntp is None:
@@ -68,16 +97,23 @@ class NTPspyMessage:
         ntp.rootdelay = self.magic
         ntp.refid = self.session_id
         ntp.reftime_frac = self.sequence_number
-        if isinstance(self.payload, bytes):
-            if len(self.payload) > 4:
+        payload = self.payload
+        if isinstance(payload, int): # every reply and client request, test it first
+            ntp.xmt_frac = payload
+        elif isinstance(payload, bytes):
+            if len(payload) > 4:
                 raise ValueError("Payload length exceeds 4 bytes.")
-            ntp.xmt_frac = int.from_bytes(self.payload.ljust(4, b'\x00'), byteorder='big')
-        elif isinstance(self.payload, int):
-            ntp.xmt_frac = self.payload
+            ntp.xmt_frac, = _U32.unpack(payload.ljust(4, b'\x00'))
         else:
             raise ValueError("Payload must be an integer or bytes.")
         ntp.rootdispersion = self.length
         return ntp
+
+    def to_frame(self) -> bytearray:
+        """serialized datagram as a mutable template, see *_OFFSET for patchable fields"""
+        frame = bytearray(NTPdatagram._SIZE)
+        self.to_ntp().pack_into(frame)
+        return frame
     
     def __repr__(self) -> str:
         return (
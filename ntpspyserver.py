@@ -2,12 +2,13 @@ import asyncio
 import threading
 import logging
 import sys
-import copy
 import signal
+import struct
 
 from ntpdatagram import NTPdatagram, NTPmode
-from ntpspymessage import NTPspyMessage, NTPspyFunction, NTPspyStatus
+from ntpspymessage import NTPspyMessage, NTPspyFunction, NTPspyStatus, BASE_CHUNK_SIZE, MAX_CHUNK_SIZE
 from timestampgen import OperationalTimestampGenerator
+from batchtransport import create_batch_endpoint
 from storageprovider import DiskStorageProvider, MemoryStorageProvider, BufferType, StorageError, FatalStorageError
 
 formatter = logging.Formatter(
@@ -18,8 +19,30 @@ logconsole = logging.StreamHandler()
 logconsole.setLevel(logging.DEBUG)
 logconsole.setFormatter(formatter)
 
+_CHUNK = struct.Struct("!5I") # payload + extension, MAX_CHUNK_SIZE bytes
+
 class NTPspyServer(asyncio.DatagramProtocol):
-    def __init__(self, path=None, host=None, port=None, magic_number=None, storage_provider=None, verbose=0, version=3, timestampgen=None, allow_overwrite=False, blocked=False):
+    # attributes read on every datagram, no per-instance __dict__
+    __slots__ = (
+        'host', 'port', 'magic_number', 'path', 'version', 'blocked', 'allow_overwrite', 'reuse_port',
+        'transport', 'payload_buffer', 'payload_view', 'reply_buffer', 'reply_template',
+        '_running', 'resumed', 'loop', 'logger', 'storage_provider', 'timestampgen',
+        'incoming_queue', 'outgoing_queue', 'stop_event',
+    )
+
+    # NTPspy function handlers, built once rather than per message
+    _HANDLERS = {
+        NTPspyFunction.PROBE: lambda server, msg, addr: server.probe(msg, addr),
+        NTPspyFunction.NEW_SESSION: lambda server, msg, addr: server.session_init(msg, addr),
+        NTPspyFunction.XFER_DATA: lambda server, msg, addr: server.transfer(msg, BufferType.DATA),
+        NTPspyFunction.CHECK_DATA: lambda server, msg, addr: server.verify(msg, BufferType.DATA),
+        NTPspyFunction.XFER_TEXT: lambda server, msg, addr: server.transfer(msg, BufferType.TEXT),
+        NTPspyFunction.CHECK_TEXT: lambda server, msg, addr: server.verify(msg, BufferType.TEXT),
+        NTPspyFunction.RENAME: lambda server, msg, addr: server.rename(msg),
+        NTPspyFunction.ABORT: lambda server, msg, addr: server.abort(msg),
+    }
+
+    def __init__(self, path=None, host=None, port=None, magic_number=None, storage_provider=None, verbose=0, version=3, timestampgen=None, allow_overwrite=False, blocked=False, reuse_port=False):
         self.host = host or "0.0.0.0"
         self.port = port or 1234
         self.magic_number = magic_number or 0xdeadbeef
@@ -29,11 +52,28 @@ class NTPspyServer(asyncio.DatagramProtocol):
         self.blocked = blocked
         # if overwrite disabled, storage provider either silently renames or fails on name collision
         self.allow_overwrite = allow_overwrite
+        # share the port with sibling worker processes, kernel spreads clients across them
+        self.reuse_port = reuse_port
         self.transport = None
-
-        # automatic processing incoming/outgoing message queues
-        self.running = True if not sys.flags.interactive else False
+        # chunk payloads are unpacked here, storage providers copy them before write() returns
+        self.payload_buffer = bytearray(MAX_CHUNK_SIZE)
+        self.payload_view = memoryview(self.payload_buffer)
+        # every reply is packed here, transport.sendto copies or sends immediately
+        self.reply_buffer = bytearray(NTPdatagram._SIZE)
+        # constant fields of every NTP reply, timestamps are filled in per request
+        self.reply_template = NTPdatagram(
+            mode = NTPmode.SERVER,
+            stratum = 15,
+            poll = 0, # 2^0 = 1 second
+            precision = -5, # ~50ms
+            rootdelay = 0x1000, # ~1 second
+            rootdispersion = 0x1000,
+            refid = 0x4C4F434C, # 'LOCL' = "undisciplined local clock"
+        )
+
+        self.resumed = None # asyncio.Event mirroring `running`, created on the event loop in start()
         self.loop = None
+        self.running = True if not sys.flags.interactive else False
 
         self.logger = logging.getLogger(type(self).__name__)
         self.logger.addHandler(logconsole)
@@ -43,20 +83,33 @@ class NTPspyServer(asyncio.DatagramProtocol):
         self.set_verbose(verbose)
         self.logger.info(f"Server created with magic number: 0x{self.magic_number:08x}, saving to {self.path}")
 
+    @property
+    def running(self) -> bool:
+        """answer datagrams as they arrive, else hold them in incoming_queue for dispatch_one()"""
+        return self._running
+
+    @running.setter
+    def running(self, running: bool) -> None:
+        self._running = running
+        if self.resumed is not None:
+            # usually set from the REPL thread, asyncio.Event is not thread safe
+            self.loop.call_soon_threadsafe(self.resumed.set if running else self.resumed.clear)
+
     def handle_datagram(self, datagram, addr):
         """discard non-ntp traffic, process rest as ntp, then ntpspy if applicable"""
-        client = addr[0]
         try:
             ntp_in = NTPdatagram.from_bytes(datagram)
         except ValueError:
-            self.logger.debug(f"{client}: Dropped non-ntp datagram")
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(f"{addr[0]}: Dropped non-ntp datagram")
             return None
         ntp_out = self.handle_ntp(ntp_in, addr)
         if ntp_in.is_ntpspy(self.magic_number):
             try:
                 spy_in = NTPspyMessage.from_ntp(ntp_in)
             except ValueError:
-                self.logger.error(f"{client}: Invalid NTPspy message")
+                self.logger.error(f"{addr[0]}: Invalid NTPspy message")
+                return ntp_out
             spy_out = self.handle_ntpspy(spy_in, addr)
             ntp_out = spy_out.to_ntp(ntp_out)
         return ntp_out
@@ -64,14 +117,9 @@ class NTPspyServer(asyncio.DatagramProtocol):
 
     def handle_ntp(self, datagram: NTPdatagram, addr) -> NTPdatagram:
         """simulate NTP server response, ref: RFC 1305"""
-        reply = copy.copy(datagram)
-        reply.mode = NTPmode.SERVER
-        reply.stratum = 15
-        reply.poll = 0  # 2^0 = 1 second
-        reply.precision = -5  # ~50ms
-        reply.rootdelay = 0x1000  # ~1 second
-        reply.rootdispersion = 0x1000
-        reply.refid = 0x4C4F434C  # 'LOCL' = "undisciplined local clock"
+        reply = self.reply_template.clone()
+        reply.leap = datagram.leap
+        reply.version = datagram.version
         self.timestampgen.apply_timestamps(datagram, reply)
         return reply  
 
@@ -82,20 +130,9 @@ class NTPspyServer(asyncio.DatagramProtocol):
             reply.status = NTPspyStatus.FATAL_ERROR
             return reply
 
-        handlers = {
-            NTPspyFunction.PROBE: lambda: self.probe(msg, addr),
-            NTPspyFunction.NEW_SESSION: lambda: self.session_init(msg, addr),
-            NTPspyFunction.XFER_DATA: lambda: self.transfer(msg, BufferType.DATA),
-            NTPspyFunction.CHECK_DATA: lambda: self.verify(msg, BufferType.DATA),
-            NTPspyFunction.XFER_TEXT: lambda: self.transfer(msg, BufferType.TEXT),
-            NTPspyFunction.CHECK_TEXT: lambda: self.verify(msg, BufferType.TEXT),
-            NTPspyFunction.RENAME: lambda: self.rename(msg),
-            NTPspyFunction.ABORT: lambda: self.abort(msg),
-        }
-
-        handler = handlers.get(msg.function)
+        handler = self._HANDLERS.get(msg.function)
         if handler:
-            return handler()
+            return handler(self, msg, addr)
         else:
             return NTPspyMessage(
                 status=NTPspyStatus.FATAL_ERROR,
@@ -108,6 +145,7 @@ class NTPspyServer(asyncio.DatagramProtocol):
         client = addr[0]
         reply = msg
         reply.version = self.version
+        reply.payload = MAX_CHUNK_SIZE # largest chunk accepted in NEW_SESSION, earlier servers echo 0
         self.logger.info(f"{client}: Handling version probe. Client: {msg.version}, Server: {self.version}, Status: {NTPspyStatus(reply.status).name}")
         return reply
     
@@ -121,10 +159,13 @@ class NTPspyServer(asyncio.DatagramProtocol):
             reply.status = NTPspyStatus.FATAL_ERROR
             self.logger.warning("Denied new session request while in blocked state")
             return reply
+        # requested chunk size in length, 0 from clients predating wide chunks
+        chunk_size = min(max(msg.length, BASE_CHUNK_SIZE), MAX_CHUNK_SIZE)
         try:
-            new_session = self.storage_provider.allocate_session()
+            new_session = self.storage_provider.allocate_session(chunk_size=chunk_size)
             reply.session_id = new_session
-            self.logger.info(f"{client}: Sending new session ID: {new_session:x}")
+            reply.length = chunk_size
+            self.logger.info(f"{client}: Sending new session ID: {new_session:x}, chunk size: {chunk_size}")
         except StorageError:
             reply.status = NTPspyStatus.FATAL_ERROR
             self.logger.error(f"Failed to allocate new session ID: {msg.session_id}")
@@ -139,10 +180,14 @@ class NTPspyServer(asyncio.DatagramProtocol):
             self.logger.error("Invalid session ID for transfer")
         else:
             # write data to existing session
-            data = msg.payload.to_bytes(4, byteorder='big')[:msg.length]
-            self.logger.debug(f"Received {len(data)} bytes {type.value} for session ID: {msg.session_id:x}")
+            _CHUNK.pack_into(self.payload_buffer, 0, msg.payload, *msg.extension)
+            data = self.payload_view[:msg.length]
+            if self.logger.isEnabledFor(logging.DEBUG): # skip formatting per chunk unless it is shown
+                self.logger.debug(f"Received {len(data)} bytes {type.value} for session ID: {msg.session_id:x}")
             try:
-                self.storage_provider.write(type, msg.session_id, msg.sequence_number, data)
+                if not self.storage_provider.write(type, msg.session_id, msg.sequence_number, data):
+                    reply.status = NTPspyStatus.ERROR # e.g. longer than the session's chunk size
+                    self.logger.error(f"Failed to write data to session ID: {msg.session_id}")
             except ValueError:
                 reply.status = NTPspyStatus.ERROR
                 self.logger.error(f"Failed to write data to session ID: {msg.session_id}")
@@ -243,10 +288,13 @@ class NTPspyServer(asyncio.DatagramProtocol):
 
     async def start(self):
         """normal server start"""
-        loop = asyncio.get_running_loop()
-        await loop.create_datagram_endpoint(lambda: self, local_addr=(self.host, self.port))
+        loop = self.loop = asyncio.get_running_loop()
+        await create_batch_endpoint(loop, lambda: self, local_addr=(self.host, self.port), reuse_port=self.reuse_port)
         self.incoming_queue = asyncio.Queue()
         self.outgoing_queue = asyncio.Queue()
+        self.resumed = asyncio.Event()
+        if self._running:
+            self.resumed.set()
         asyncio.create_task(self._transmit_loop())
         asyncio.create_task(self._dispatch_loop())
         self.logger.info(f"Server started on {self.host}:{self.port}")
@@ -262,8 +310,10 @@ class NTPspyServer(asyncio.DatagramProtocol):
 
         if threading.current_thread() is threading.main_thread():
             try:
-                signal.signal(signal.SIGINT, lambda sig, frame: shutdown())
-                signal.signal(signal.SIGTERM, lambda sig, frame: shutdown())
+                # the handler runs outside the loop: hand over through call_soon_threadsafe,
+                # which also wakes a loop idling in select()
+                signal.signal(signal.SIGINT, lambda sig, frame: loop.call_soon_threadsafe(shutdown))
+                signal.signal(signal.SIGTERM, lambda sig, frame: loop.call_soon_threadsafe(shutdown))
             except ValueError:
                 self.logger.warning("Signal handling is not supported in this context.")
 
@@ -272,28 +322,49 @@ class NTPspyServer(asyncio.DatagramProtocol):
         except asyncio.CancelledError:
             self.logger.info("Server shutting down.")
         finally:
+            self.storage_provider.close()
+            self.timestampgen.close()
             self.logger.info("Shutdown complete.")
 
     def connection_made(self, transport):
         self.transport = transport
 
     def datagram_received(self, data, addr):
-        """enqueue incoming UDP packets"""
-        self.incoming_queue.put_nowait((data, addr))
+        """answer incoming UDP packets inline, enqueue them while paused"""
+        if not self._running:
+            self.incoming_queue.put_nowait((data, addr))
+            return
+        try:
+            response = self.handle_datagram(data, addr)
+        except Exception as e:
+            self.logger.error(f"Unhandled exception: {e}", exc_info=True)
+            return
+        if response:
+            response.pack_into(self.reply_buffer)
+            self.transport.sendto(self.reply_buffer, addr)
 
     async def _transmit_loop(self):
         """auto send outgoing packets"""
         while True:
             response, addr = await self.outgoing_queue.get()
-            self.transport.sendto(response.to_bytes(), addr)
+            response.pack_into(self.reply_buffer)
+            self.transport.sendto(self.reply_buffer, addr)
 
     async def _dispatch_loop(self):
-        """process incoming datagrams automatically"""
+        """process datagrams queued while paused, once running again"""
         while True:
             try:
-                if self.running:
-                    await self.dispatch_one()
-                await asyncio.sleep(0.01)
+                if not self.resumed.is_set():
+                    await self.resumed.wait() # paused, datagrams wait for dispatch_one()
+                    continue
+                datagram, addr = await self.incoming_queue.get()
+                if not self.resumed.is_set():
+                    # paused while waiting, leave the datagram for dispatch_one()
+                    self.incoming_queue.put_nowait((datagram, addr))
+                    continue
+                response = self.handle_datagram(datagram, addr)
+                if response:
+                    self.outgoing_queue.put_nowait((response, addr))
             except Exception as e:
                 self.logger.error(f"Unhandled exception: {e}", exc_info=True)
                 break
@@ -307,8 +378,10 @@ class NTPspyServer(asyncio.DatagramProtocol):
                 self.outgoing_queue.put_nowait((response, addr))
 
     def purge_queues(self):
-        self.incoming_queue = asyncio.Queue()
-        self.outgoing_queue = asyncio.Queue()
+        # drain in place, the dispatch and transmit loops are waiting on these queues
+        for queue in (self.incoming_queue, self.outgoing_queue):
+            while not queue.empty():
+                queue.get_nowait()
 
     def dump_queue(self):
         print(f"Incoming: {self.incoming_queue.qsize()} packets")
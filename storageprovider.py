@@ -1,6 +1,6 @@
 import datetime
-import io
 import threading
+import time
 import zlib
 import logging
 import os
@@ -9,7 +9,7 @@ from enum import Enum
 
 # each StorageProvider provides storage for 2 data streams: 
 #   'data' (NTPspy payload) and 'text' (original filename of payload - optional)
-# provider receives payload in chunks <= 4 bytes
+# provider receives payload in chunks of up to `chunk_size` bytes (agreed per session, default 4)
 # incoming chunks are identified by 
 #   type ('data' | 'text')
 #   session ID (1-0xFFFFFFFF)
@@ -30,14 +30,17 @@ class StorageProvider(ABC):
         self.logger.setLevel(logging.DEBUG)
 
     @abstractmethod
-    def allocate_session(self, session_id: int = None) -> int:
+    def allocate_session(self, session_id: int = None, chunk_size: int = 4) -> int:
         """reserve the requested session ID if provided and available, 
-           else allocate the lowest available ID"""
+           else allocate the lowest available ID
+           chunk `sequence` numbers of the session address `chunk_size` byte slots"""
         pass
 
     @abstractmethod
     def write(self, type: str, session_id: int, sequence: int, data: bytes, length: int) -> bool:
-        """write `length` bytes at index `sequence` to buffer `type` associated with `session_id`"""
+        """write `length` bytes at index `sequence` to buffer `type` associated with `session_id`
+           `data` may be a view of a reused buffer: copy it, do not keep a reference
+           return False if the write fails or `data` is longer than the session's `chunk_size`"""
         pass
 
     @abstractmethod
@@ -61,6 +64,10 @@ class StorageProvider(ABC):
         """delete all active sessions"""
         pass
 
+    def close(self) -> None:
+        """release open resources (e.g. file descriptors) on shutdown, sessions remain valid"""
+        pass
+
     def _generate_filename(self, session_id: int) -> str:
         timestamp = datetime.datetime.now().strftime("%y%m%d-%H%M%S")
         return f"{timestamp}-{session_id:08x}"
@@ -73,18 +80,72 @@ class FatalStorageError(StorageError):
     """Indicates a fatal error that requires session termination."""
     pass
 
+if hasattr(os, "pwrite"):
+    _pwrite = os.pwrite
+else:
+    def _pwrite(fd: int, data: bytes, offset: int) -> int:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
+class _BufferWriter:
+    """open descriptor for one session buffer file
+       sequential chunks are coalesced in memory and written in blocks,
+       a chunk at any other offset starts a new block (e.g. retransmits)"""
+    def __init__(self, path: str, block_size: int, chunk_size: int):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        self.block_size = block_size
+        self.chunk_size = chunk_size # session's bytes per sequence number
+        self.pending = bytearray()
+        self.offset = 0 # file offset of first pending byte
+        self.last_used = time.monotonic()
+
+    def write(self, offset: int, data: bytes) -> None:
+        self.last_used = time.monotonic()
+        if offset != self.offset + len(self.pending):
+            self.flush()
+            self.offset = offset
+        self.pending += data
+        if len(self.pending) >= self.block_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.pending:
+            with memoryview(self.pending) as view:
+                written = 0
+                while written < len(view): # pwrite may write less than asked, e.g. interrupted
+                    written += _pwrite(self.fd, view[written:], self.offset + written)
+            self.offset += len(self.pending)
+            self.pending.clear()
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            os.close(self.fd)
+
 class DiskStorageProvider(StorageProvider):
-    def __init__(self, base_path: str):
+    def __init__(self, base_path: str, block_size: int = 64 * 1024, idle_timeout: float = 30, remove_orphans: bool = True):
         super().__init__()
         self.base_path = base_path
         os.makedirs(self.base_path, exist_ok=True)
         self.sessions = {}
         self.lock = threading.Lock()
-        self.max_chunksize = 4 # bytes
-
-        # clean up orphaned buffer files
-        for file_name in os.listdir(self.base_path):
-            file_path = os.path.join(self.base_path, file_name)
+        self.chunk_sizes = {} # session_id -> bytes per sequence number
+        # open buffer files, keyed by (session_id, BufferType)
+        self.writers = {}
+        self.block_size = block_size # bytes coalesced before hitting the disk
+        self.idle_timeout = idle_timeout # seconds before an unused descriptor is closed
+        self.closed = threading.Event() # ends the idle reaper
+        threading.Thread(target=self._reap_idle_writers, daemon=True).start()
+        if remove_orphans:
+            self.remove_orphaned_files(self.base_path, self.logger)
+
+    @staticmethod
+    def remove_orphaned_files(base_path: str, logger: logging.Logger) -> None:
+        """delete session buffer files left behind by an earlier run
+           unsafe while another process serves sessions from `base_path`"""
+        for file_name in os.listdir(base_path):
+            file_path = os.path.join(base_path, file_name)
             if os.path.isfile(file_path):
                 if not any(file_name.endswith(ext) for ext in [".dat", ".txt"]):
                     continue #skip non-buffer file extensions
@@ -96,9 +157,9 @@ class DiskStorageProvider(StorageProvider):
                 if len(basename) != 8:
                     continue #skip hex.dat or .txt but not 8 digits
                 os.remove(file_path)
-                self.logger.info(f"Removed orphaned file: {file_name}")
+                logger.info(f"Removed orphaned file: {file_name}")
 
-    def allocate_session(self, session_id: int = None) -> int:
+    def allocate_session(self, session_id: int = None, chunk_size: int = 4) -> int:
         with self.lock:
             while True:
                 if session_id is None:
@@ -107,33 +168,45 @@ class DiskStorageProvider(StorageProvider):
                     self.logger.error(f"Session ID {session_id:x} already in use")
                     raise FatalStorageError("Session ID already in use")
                 
-                data_file = os.path.join(self.base_path, f"{session_id:08x}.dat")
-                text_file = os.path.join(self.base_path, f"{session_id:08x}.txt")
-                if os.path.exists(data_file) or os.path.exists(text_file):
+                buffers = {"data": f"{session_id:08x}.dat", "text": f"{session_id:08x}.txt"}
+                # exclusive create: another server process sharing base_path may race for the same ID
+                created = []
+                try:
+                    for buffer_type in [BufferType.DATA, BufferType.TEXT]:
+                        file_path = os.path.join(self.base_path, buffers[buffer_type.value])
+                        with open(file_path, "xb"):
+                            created.append(file_path)
+                except FileExistsError:
+                    for file_path in created:
+                        os.remove(file_path)
                     self.logger.warning(f"Files for session ID {session_id:x} already exist, skipping")
                     session_id += 1
                     continue
-                
-                self.sessions[session_id] = {"data": f"{session_id:08x}.dat", "text": f"{session_id:08x}.txt"}
-                for buffer_type in [BufferType.DATA, BufferType.TEXT]:
-                    file_path = os.path.join(self.base_path, self.sessions[session_id][buffer_type.value])
-                    with open(file_path, "wb"):
-                        pass # `touch file_path`
+
+                self.sessions[session_id] = buffers
+                self.chunk_sizes[session_id] = chunk_size
                 
                 self.logger.info(f"Allocated session ID: {session_id:x}")
                 return session_id
 
     def write(self, type: BufferType, session_id: int, sequence: int, data: bytes) -> bool:
         with self.lock:
-            if session_id not in self.sessions:
+            # an open writer implies a live session, so steady-state chunks cost one dict lookup
+            writer = self.writers.get((session_id, type))
+            if writer is None and session_id not in self.sessions:
                 self.logger.error(f"Invalid session ID: {session_id:x}")
                 raise FatalStorageError("Invalid session ID")
             try:
-                file_path = os.path.join(self.base_path, self.sessions[session_id][type.value])
-                with open(file_path, "ab") as f:
-                    f.seek(sequence * self.max_chunksize)
-                    f.write(data)
-                self.logger.debug(f"Wrote {len(data)} bytes to session {session_id:x} {type.value} buffer @ {(sequence * self.max_chunksize):x}")
+                if writer is None:
+                    file_path = os.path.join(self.base_path, self.sessions[session_id][type.value])
+                    writer = self.writers[(session_id, type)] = _BufferWriter(file_path, self.block_size, self.chunk_sizes[session_id])
+                if len(data) > writer.chunk_size:
+                    # would overwrite the start of the next chunk
+                    self.logger.error(f"Rejected {len(data)} byte chunk for session {session_id:x}, chunk size is {writer.chunk_size}")
+                    return False
+                writer.write(sequence * writer.chunk_size, data)
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug(f"Wrote {len(data)} bytes to session {session_id:x} {type.value} buffer @ {(sequence * writer.chunk_size):x}")
                 return True
             except Exception as e:
                 self.logger.error(f"Failed to write to session {session_id:x}: {e}")
@@ -147,9 +220,17 @@ class DiskStorageProvider(StorageProvider):
             
             file_path = os.path.join(self.base_path, self.sessions[session_id][type.value])
             try:
-                with open(file_path, "rb") as f:
-                    data = f.read()
-                checksum = zlib.crc32(data)
+                self._close_writer(session_id, type)
+                # stream the buffer file through one reused block, never holding the whole file
+                checksum = 0
+                block = bytearray(self.block_size)
+                view = memoryview(block)
+                with open(file_path, "rb", buffering=0) as f:
+                    while True:
+                        nbytes = f.readinto(block)
+                        if not nbytes:
+                            break
+                        checksum = zlib.crc32(view[:nbytes], checksum)
                 self.logger.debug(f"Calculated CRC32 for {type.value} buffer of session {session_id:x}: {checksum:08x}")
                 return checksum
             except Exception as e:
@@ -162,6 +243,9 @@ class DiskStorageProvider(StorageProvider):
                 self.logger.error(f"Invalid session ID: {session_id:x}")
                 raise FatalStorageError("Invalid session ID")
 
+            # buffers must be complete on disk before reading or renaming
+            self._close_writers(session_id)
+
             # recover original filename from text buffer if available
             handle = self._read_filename(session_id)
 
@@ -194,6 +278,34 @@ class DiskStorageProvider(StorageProvider):
                 self.logger.error(f"Failed to finalize session {session_id:x}: {e}")
                 raise FatalStorageError("Failed to finalize session")
 
+    def _close_writer(self, session_id: int, type: BufferType) -> None:
+        writer = self.writers.pop((session_id, type), None)
+        if writer:
+            writer.close()
+
+    def _close_writers(self, session_id: int) -> None:
+        for buffer_type in [BufferType.DATA, BufferType.TEXT]:
+            self._close_writer(session_id, buffer_type)
+
+    def close(self) -> None:
+        self.closed.set()
+        with self.lock:
+            for session_id, type in list(self.writers):
+                self._close_writer(session_id, type)
+
+    def _reap_idle_writers(self) -> None:
+        """flush and close descriptors of sessions gone quiet, reopened on next write"""
+        while not self.closed.wait(self.idle_timeout):
+            with self.lock:
+                cutoff = time.monotonic() - self.idle_timeout
+                for (session_id, type), writer in list(self.writers.items()):
+                    if writer.last_used < cutoff:
+                        try:
+                            self._close_writer(session_id, type)
+                            self.logger.debug(f"Closed idle {type.value} buffer for session {session_id:x}")
+                        except OSError as e:
+                            self.logger.error(f"Failed to flush idle session {session_id:x}: {e}")
+
     def _check_path(self, target_path: str) -> bool:
         abs_path = os.path.abspath(self.base_path)
         target_path = os.path.abspath(os.path.join(abs_path, target_path))
@@ -222,6 +334,7 @@ class DiskStorageProvider(StorageProvider):
                 self.logger.error(f"Invalid session ID: {session_id:x}")
                 raise FatalStorageError("Invalid session ID")
 
+            self._close_writers(session_id)
             for buffer_type in [BufferType.DATA, BufferType.TEXT]:
                 file_path = os.path.join(self.base_path, self.sessions[session_id][buffer_type.value])
                 if os.path.exists(file_path):
@@ -229,23 +342,29 @@ class DiskStorageProvider(StorageProvider):
                     self.logger.info(f"Deleted {buffer_type.value} buffer for session {session_id:x}")
 
             del self.sessions[session_id]
+            del self.chunk_sizes[session_id]
             self.logger.info(f"Released session ID: {session_id:x}")
 
     def purge_sessions(self) -> None:
         with self.lock:
             dead_sessions = list(self.sessions.keys())
             for session_id in dead_sessions:
+                self._close_writers(session_id)
                 for buffer_type in [BufferType.DATA, BufferType.TEXT]:
                     file_path = os.path.join(self.base_path, self.sessions[session_id][buffer_type.value])
                     if os.path.exists(file_path):
                         os.remove(file_path)
                         self.logger.info(f"Deleted {buffer_type.value} buffer for session {session_id:x}")
                 del self.sessions[session_id]
+                del self.chunk_sizes[session_id]
         self.logger.info(f"Purged all active sessions: {', '.join(f'{id:x}' for id in dead_sessions)}")
 
     def list_sessions(self) -> None:
         with self.lock:
             for session_id, buffers in self.sessions.items():
+                writer = self.writers.get((session_id, BufferType.DATA))
+                if writer:
+                    writer.flush()
                 data_file = os.path.join(self.base_path, buffers[BufferType.DATA.value])
                 data_length = os.path.getsize(data_file)
                 print(f"{session_id:08x}: {data_length}")
@@ -257,16 +376,17 @@ class MemoryStorageProvider(StorageProvider):
         self.sessions = {}
         self.files = {}
         self.lock = threading.Lock()
-        self.max_chunksize = 4 # bytes
+        self.chunk_sizes = {} # session_id -> bytes per sequence number
 
-    def allocate_session(self, session_id: int = None) -> int:
+    def allocate_session(self, session_id: int = None, chunk_size: int = 4) -> int:
         with self.lock:
             if session_id is None:
                 session_id = max(self.sessions.keys(), default=0) + 1
             if session_id in self.sessions:
                 self.logger.error(f"Session ID {session_id:x} already in use")
                 raise FatalStorageError("Session ID already in use")
-            self.sessions[session_id] = {"data": io.BytesIO(), "text": io.BytesIO()}
+            self.sessions[session_id] = {"data": bytearray(), "text": bytearray()}
+            self.chunk_sizes[session_id] = chunk_size
             self.logger.info(f"Allocated session ID: {session_id:x}")
             return session_id
 
@@ -277,8 +397,15 @@ class MemoryStorageProvider(StorageProvider):
                 raise FatalStorageError("Invalid session ID")
             try:
                 buffer = self.sessions[session_id][type.value]
-                buffer.seek(sequence * self.max_chunksize)
-                buffer.write(data)
+                chunk_size = self.chunk_sizes[session_id]
+                if len(data) > chunk_size:
+                    # would overwrite the start of the next chunk
+                    self.logger.error(f"Rejected {len(data)} byte chunk for session {session_id:x}, chunk size is {chunk_size}")
+                    return False
+                offset = sequence * chunk_size
+                if offset > len(buffer):
+                    buffer.extend(bytes(offset - len(buffer))) # zero fill ahead of out-of-order chunks
+                buffer[offset:offset + len(data)] = data
                 return True
             except Exception as e:
                 self.logger.error(f"Failed write to session {session_id:x}: {e}")
@@ -289,9 +416,7 @@ class MemoryStorageProvider(StorageProvider):
             if session_id not in self.sessions:
                 self.logger.error(f"Invalid session ID: {session_id:x}")
                 raise FatalStorageError("Invalid session ID")
-            buffer = self.sessions[session_id][type.value]
-            buffer.seek(0)
-            crc32 = zlib.crc32(buffer.read())
+            crc32 = zlib.crc32(self.sessions[session_id][type.value])
             self.logger.debug(f"Calculating CRC32 for session {session_id:x} ({type.value}): {crc32:08x}")
             return crc32
 
@@ -301,9 +426,7 @@ class MemoryStorageProvider(StorageProvider):
                 self.logger.error(f"Invalid session ID: {session_id:x}")
                 raise FatalStorageError("Invalid session ID")
 
-            text_buffer = self.sessions[session_id][BufferType.TEXT.value]
-            text_buffer.seek(0)
-            handle = text_buffer.read().decode()
+            handle = self.sessions[session_id][BufferType.TEXT.value].decode()
             if not handle:
                 handle = self._generate_filename(session_id)
                 self.logger.info(f"Using generated filename: {handle}")
@@ -312,7 +435,7 @@ class MemoryStorageProvider(StorageProvider):
                 handle = self._resolve_collision(handle, overwrite)
 
             self.files[handle] = self.sessions[session_id][BufferType.DATA.value]
-            length = len(self.files[handle].getbuffer())
+            length = len(self.files[handle])
             self.logger.info(f"Saved session {session_id:x} to '{handle}' ({length} bytes)")
             return handle
         
@@ -320,6 +443,7 @@ class MemoryStorageProvider(StorageProvider):
         with self.lock:
             if session_id in self.sessions:
                 del self.sessions[session_id]
+                del self.chunk_sizes[session_id]
                 self.logger.info(f"Released session ID: {session_id:x}")
             else:
                 self.logger.error(f"Invalid session ID: {session_id:x}")
@@ -328,6 +452,7 @@ class MemoryStorageProvider(StorageProvider):
     def purge_sessions(self) -> None:
         with self.lock:
             self.sessions.clear()
+            self.chunk_sizes.clear()
             self.logger.info("Purged all active sessions")
 
     def _resolve_collision(self, filename: str, overwrite: bool) -> str:
@@ -349,27 +474,27 @@ class MemoryStorageProvider(StorageProvider):
     def list_sessions(self) -> None:
         with self.lock:
             for session_id, buffers in self.sessions.items():
-                data_length = len(buffers[BufferType.DATA.value].getbuffer())
-                filename = buffers[BufferType.TEXT.value].getvalue().decode() or None
+                data_length = len(buffers[BufferType.DATA.value])
+                filename = buffers[BufferType.TEXT.value].decode() or None
                 print(f"{session_id:08x}: {data_length} ({filename})")
 
     def print_session(self, session_id: int) -> None:
         with self.lock:
             if session_id in self.sessions:
-                print(self.sessions[session_id][BufferType.DATA.value].getvalue())
+                print(bytes(self.sessions[session_id][BufferType.DATA.value]))
             else:
                 print(f"Session ID {session_id:x} not found")
 
     def list_files(self) -> None:
         with self.lock:
             for filename, buffer in self.files.items():
-                length = len(buffer.getbuffer())
+                length = len(buffer)
                 print(f"{length} {filename}")
 
     def print_file(self, filename: str) -> None:
         with self.lock:
             if filename in self.files:
-                print(self.files[filename].getvalue())
+                print(bytes(self.files[filename]))
             else:
                 print(f"File '{filename}' not found")
     
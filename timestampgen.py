@@ -1,5 +1,6 @@
 import time
 import random
+import threading
 
 from abc import ABC, abstractmethod
 from ntpdatagram import NTPdatagram
@@ -12,13 +13,41 @@ class TimestampGenerator(ABC):
         """modify reply datagram with appropriate timestamps"""
         pass
 
+    def close(self) -> None:
+        """stop background work (e.g. clock threads) on shutdown"""
+        pass
+
+class CoarseClock:
+    """whole NTP seconds, refreshed by a background thread every `resolution` seconds
+       so per-packet readers skip the clock call"""
+    def __init__(self, resolution: float = 0.05):
+        self.resolution = resolution
+        self.now = int(time.time()) + UNIX_TO_NTP
+        self.stopped = threading.Event()
+        threading.Thread(target=self._tick, daemon=True).start()
+
+    def _tick(self) -> None:
+        while not self.stopped.wait(self.resolution):
+            self.now = int(time.time()) + UNIX_TO_NTP
+
+    def stop(self) -> None:
+        """end the refresh thread, `now` keeps its last value"""
+        self.stopped.set()
+
 class OperationalTimestampGenerator(TimestampGenerator):
+    def __init__(self, clock: CoarseClock = None):
+        self.own_clock = clock is None # a clock passed in may be shared, its owner stops it
+        self.clock = clock or CoarseClock()
+
+    def close(self) -> None:
+        if self.own_clock:
+            self.clock.stop()
+
     def apply_timestamps(self, request: NTPdatagram, reply: NTPdatagram) -> None:
         """real NTP timestamps based on system clock"""
         reply.org_whole = request.xmt_whole
         reply.org_frac = request.xmt_frac
-        current_time = time.time() + UNIX_TO_NTP
-        reply.rec_whole = int(current_time)
+        reply.rec_whole = self.clock.now # fraction is random below, whole seconds suffice
         reply.rec_frac = random.randint(0, 2**32 - 1)
         reply.xmt_whole = reply.rec_whole
         if reply.xmt_whole == reply.rec_whole and request.xmt_frac < reply.rec_frac: